@@ -1,7 +1,6 @@
 """
 Remove a namespace in an F5 XC tenant.
 """
-import json
 import boto3
 from f5xc_tops_py_client import session, ns
 
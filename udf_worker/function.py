@@ -1,11 +1,11 @@
-import json
+import logging
 import os
 import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait
 import boto3
-
-lambda_client = boto3.client("lambda")
-dynamodb = boto3.client("dynamodb")
+import orjson
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.config import Config
 
 DEPLOYMENT_STATE_TABLE = os.getenv("DEPLOYMENT_STATE_TABLE")
 LAB_CONFIGURATION_TABLE = os.getenv("LAB_CONFIGURATION_TABLE")
@@ -13,23 +13,80 @@ USER_CREATE_LAMBDA = os.getenv("USER_CREATE_LAMBDA_FUNCTION")
 USER_REMOVE_LAMBDA = os.getenv("USER_REMOVE_LAMBDA_FUNCTION")
 NS_CREATE_LAMBDA = os.getenv("NS_CREATE_LAMBDA_FUNCTION")
 NS_REMOVE_LAMBDA = os.getenv("NS_REMOVE_LAMBDA_FUNCTION")
+DEPLOYMENT_EMAIL_INDEX = os.getenv("DEPLOYMENT_EMAIL_INDEX")
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", min(32, (os.cpu_count() or 2) * 8)))
+PARAMETER_CACHE_TTL = 300
+LAB_INFO_CACHE_TTL = 60
+USER_CREATE_PARAMETERS = {"tenant-url", "token-value", "idm-type"}
+
+# SSM values keyed by parameter names, as (fetched_at, values)
+parameter_cache = {}
+
+# Lab configuration keyed by lab_id, as (fetched_at, lab_info)
+lab_info_cache = {}
+
+# Base paths whose tenant credentials could not be read, as failed_at; retried after PARAMETER_CACHE_TTL
+credentials_unavailable = {}
+
+# check_existing_user_in_tenant results keyed by (email, tenant_url); cleared at the start of each invocation
+# and dropped when an INSERT writes tenant_url for that user
+existing_user_cache = {}
+
+# Epoch seconds at which the current invocation started; set by lambda_handler
+invocation_started_at = 0
+
+REQUIRED_ENV_VARS = {
+    "DEPLOYMENT_STATE_TABLE": DEPLOYMENT_STATE_TABLE,
+    "LAB_CONFIGURATION_TABLE": LAB_CONFIGURATION_TABLE,
+    "USER_CREATE_LAMBDA_FUNCTION": USER_CREATE_LAMBDA,
+    "NS_CREATE_LAMBDA_FUNCTION": NS_CREATE_LAMBDA,
+}
+missing_env_vars = [name for name, value in REQUIRED_ENV_VARS.items() if not value]
+if missing_env_vars:
+    raise ValueError(f"Missing required environment variables: {', '.join(missing_env_vars)}")
+
+logger = logging.getLogger()
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+# Let botocore absorb throttling with client-side rate limiting instead of failing the record,
+# and keep one pooled keep-alive connection per worker thread across warm invocations
+boto_config = Config(
+    tcp_keepalive=True,
+    max_pool_connections=MAX_WORKERS,
+    retries={"mode": "adaptive", "max_attempts": 5}
+)
+
+aws = boto3.session.Session()
+lambda_client = aws.client("lambda", config=boto_config)
+dynamodb = aws.client("dynamodb", config=boto_config)
+ssm = aws.client("ssm", config=boto_config)
+
+deserializer = TypeDeserializer()
+
+# Worker threads are kept for the life of the container
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
 
 
 def invoke_lambda(function_name: str, payload: dict) -> dict:
     """Invoke another Lambda function synchronously."""
-    try:
-        response = lambda_client.invoke(
-            FunctionName=function_name,
-            InvocationType="RequestResponse",
-            Payload=json.dumps(payload)
-        )
-        return json.loads(response["Payload"].read())
-    except Exception as e:
-        raise RuntimeError(f"Failed to invoke Lambda '{function_name}': {e}") from e
+    response = lambda_client.invoke(
+        FunctionName=function_name,
+        InvocationType="RequestResponse",
+        Payload=orjson.dumps(payload)
+    )
+    return orjson.loads(response["Payload"].read())
 
 
 def get_lab_info(lab_id: str) -> dict:
-    """Fetch lab information from DynamoDB using the lab ID."""
+    """
+    Fetch lab information from DynamoDB using the lab ID.
+    Labs fetched within the last LAB_INFO_CACHE_TTL seconds are served from the container cache,
+    so callers must not mutate the result.
+    """
+    cached = lab_info_cache.get(lab_id)
+    if cached and time.monotonic() - cached[0] < LAB_INFO_CACHE_TTL:
+        return cached[1]
+
     try:
         response = dynamodb.get_item(
             TableName=LAB_CONFIGURATION_TABLE,
@@ -39,7 +96,7 @@ def get_lab_info(lab_id: str) -> dict:
         if "Item" not in response:
             raise RuntimeError(f"Lab ID '{lab_id}' not found in DynamoDB.")
 
-        item = response["Item"]
+        item = {k: deserializer.deserialize(v) for k, v in response["Item"].items()}
 
         required_fields = ["ssm_base_path", "group_names", "namespace_roles", "user_ns"]
         missing_fields = [field for field in required_fields if field not in item]
@@ -47,102 +104,255 @@ def get_lab_info(lab_id: str) -> dict:
             raise RuntimeError(f"Missing required fields in lab info: {', '.join(missing_fields)}")
 
         lab_info = {
-            "ssm_base_path": item["ssm_base_path"]["S"],
-            "group_names": [g["S"] for g in item["group_names"]["L"]],
-            "namespace_roles": [{"namespace": role["M"]["namespace"]["S"], "role": role["M"]["role"]["S"]} for role in item["namespace_roles"]["L"]],
-            "user_ns": item["user_ns"]["BOOL"],
-            "pre_lambda": item.get("pre_lambda", {}).get("S", None),
-            "post_lambda": item.get("post_lambda", {}).get("S", None)
+            "ssm_base_path": item["ssm_base_path"],
+            "group_names": item["group_names"],
+            "namespace_roles": [{"namespace": role["namespace"], "role": role["role"]} for role in item["namespace_roles"]],
+            "user_ns": item["user_ns"],
+            "pre_lambda": item.get("pre_lambda"),
+            "post_lambda": item.get("post_lambda")
         }
-
-        return lab_info
     except Exception as e:
         raise RuntimeError(f"Failed to fetch lab info from DynamoDB: {e}") from e
 
-def get_parameters(parameters: list, region_name: str = "us-east-1") -> dict:
+    lab_info_cache[lab_id] = (time.monotonic(), lab_info)
+    return lab_info
+
+def get_parameters(parameters: list) -> dict:
     """
     Fetch parameters from AWS Parameter Store.
+    Values fetched within the last PARAMETER_CACHE_TTL seconds are served from the container cache.
     """
+    cache_key = tuple(parameters)
+    cached = parameter_cache.get(cache_key)
+    if cached and time.monotonic() - cached[0] < PARAMETER_CACHE_TTL:
+        return cached[1]
+
     try:
-        aws = boto3.session.Session()
-        ssm = aws.client("ssm", region_name=region_name)
         response = ssm.get_parameters(Names=parameters, WithDecryption=True)
-        return {param["Name"].split("/")[-1]: param["Value"] for param in response["Parameters"]}
+        params = {param["Name"].rsplit("/", 1)[-1]: param["Value"] for param in response["Parameters"]}
     except Exception as e:
         raise RuntimeError(f"Failed to fetch parameters: {e}") from e
+
+    parameter_cache[cache_key] = (time.monotonic(), params)
+    return params
+
+def get_tenant_credentials(ssm_base_path: str) -> dict:
+    """
+    Fetch the tenant token and IDM type for USER_CREATE, or return an empty dict if this role may not read them.
+    A failed fetch is remembered for PARAMETER_CACHE_TTL seconds so later deployments do not repeat it.
+    """
+    failed_at = credentials_unavailable.get(ssm_base_path)
+    if failed_at is not None and time.monotonic() - failed_at < PARAMETER_CACHE_TTL:
+        return {}
+
+    try:
+        credentials = get_parameters([f"{ssm_base_path}/token-value", f"{ssm_base_path}/idm-type"])
+    except RuntimeError as e:
+        if failed_at is None:
+            logger.warning("Tenant credentials under %s not passed to USER_CREATE: %s", ssm_base_path, e)
+        credentials_unavailable[ssm_base_path] = time.monotonic()
+        return {}
+
+    credentials_unavailable.pop(ssm_base_path, None)
+    return credentials
     
-def update_deployment_state(dep_id: str, updates: dict):
-    """Update multiple fields in the deployment state in DynamoDB."""
+def build_state_update(dep_id: str, updates: dict, expected: str = None, abandoned_before: int = None) -> dict:
+    """
+    Build the UpdateItem parameters for a deployment state change.
+    Shared by single updates and batched transactions.
+    """
+    update_expression = "SET " + ", ".join([f"#{k} = :{k}" for k in updates.keys()]) + ", #updated_at = :updated_at"
+    expression_values = {
+        f":{k}": {"S": v} if isinstance(v, str) else {"BOOL": v} if isinstance(v, bool) else {"N": str(v)}
+        for k, v in updates.items()
+    }
+    expression_values[":updated_at"] = {"N": str(int(time.time()))}
+    expression_names = {f"#{k}": k for k in updates.keys()}
+    expression_names["#updated_at"] = "updated_at"
+
+    params = {
+        "TableName": DEPLOYMENT_STATE_TABLE,
+        "Key": {"dep_id": {"S": dep_id}},
+    }
+    if expected is not None:
+        # claimed_at is written only here, unlike updated_at which udf_dispatch also bumps on TTL heartbeats
+        update_expression += ", #claimed_at = :updated_at ADD #attempts :one"
+        expression_names["#claimed_at"] = "claimed_at"
+        expression_names["#attempts"] = "attempts"
+        expression_names["#status"] = "deployment_status"
+        expression_values[":one"] = {"N": "1"}
+        expression_values[":expected"] = {"S": expected}
+        params["ConditionExpression"] = "#status = :expected"
+        if abandoned_before is not None:
+            expression_values[":in_progress"] = {"S": "IN_PROGRESS"}
+            expression_values[":abandoned_before"] = {"N": str(abandoned_before)}
+            params["ConditionExpression"] += " OR (#status = :in_progress AND #claimed_at <= :abandoned_before)"
+    else:
+        # Never recreate a deployment that has expired and been deleted; it would have no ttl for udf_clean to find
+        params["ConditionExpression"] = "attribute_exists(dep_id)"
+
+    params["UpdateExpression"] = update_expression
+    params["ExpressionAttributeNames"] = expression_names
+    params["ExpressionAttributeValues"] = expression_values
+    return params
+
+def update_deployment_state(dep_id: str, updates: dict, expected: str = None, abandoned_before: int = None):
+    """
+    Update multiple fields in the deployment state in DynamoDB.
+    If expected is set, the update only applies while deployment_status still equals it, or with abandoned_before
+    also while it is IN_PROGRESS and was claimed at or before that time. The transition is stamped in claimed_at and
+    counted in attempts; the updated attributes are returned, or None if the status did not match.
+    Plain updates only apply while the deployment still exists; they ask DynamoDB for no attributes back and
+    return an empty dict, or None if the deployment is gone.
+    """
     try:
-        update_expression = "SET " + ", ".join([f"#{k} = :{k}" for k in updates.keys()])
-        expression_values = {
-            f":{k}": {("S" if isinstance(v, str) else "BOOL" if isinstance(v, bool) else "N"): str(v)}
-            for k, v in updates.items()
-        }
-        expression_names = {f"#{k}": k for k in updates.keys()}
-
-        dynamodb.update_item(
-            TableName=DEPLOYMENT_STATE_TABLE,
-            Key={"dep_id": {"S": dep_id}},
-            UpdateExpression=update_expression,
-            ExpressionAttributeNames=expression_names,
-            ExpressionAttributeValues=expression_values
+        response = dynamodb.update_item(
+            **build_state_update(dep_id, updates, expected, abandoned_before),
+            ReturnValues="NONE" if expected is None else "UPDATED_NEW",
+            ReturnItemCollectionMetrics="NONE"
         )
+    except dynamodb.exceptions.ConditionalCheckFailedException:
+        return None
     except Exception as e:
         raise RuntimeError(f"Failed to update deployment state in DynamoDB: {e}") from e
 
+    return response.get("Attributes", {})
+
+def commit_deployment_state(dep_id: str, updates: dict):
+    """
+    Commit the terminal state of one deployment, marking it FAILED if that write is rejected.
+    A deployment deleted in the meantime is left alone.
+    """
+    try:
+        if update_deployment_state(dep_id, updates) is None:
+            logger.info("Deployment %s was removed before its terminal state was committed", dep_id)
+    except Exception as e:
+        logger.error("Failed to commit terminal state for %s: %s", dep_id, e)
+        update_deployment_state(dep_id, {"deployment_status": "FAILED"})
+
+def commit_deployment_states(states: dict):
+    """
+    Commit the terminal state of several deployments, keyed by dep_id.
+    Up to 100 deployments share one transaction. If it fails for any reason, including a deployment that has
+    since been deleted, each deployment is written on its own.
+    Deployments that cannot even be marked FAILED stay IN_PROGRESS for a stream retry to take over,
+    and the first such error is raised once every deployment has been attempted.
+    """
+    errors = []
+    items = list(states.items())
+    for i in range(0, len(items), 100):
+        chunk = items[i:i + 100]
+        if len(chunk) > 1:
+            try:
+                dynamodb.transact_write_items(
+                    TransactItems=[{"Update": build_state_update(dep_id, updates)} for dep_id, updates in chunk]
+                )
+                continue
+            except Exception as e:
+                logger.warning("Failed to commit deployment states in one transaction, writing them individually: %s", e)
+        for dep_id, updates in chunk:
+            try:
+                commit_deployment_state(dep_id, updates)
+            except Exception as e:
+                errors.append(e)
+
+    if errors:
+        raise errors[0]
+
 def check_existing_user_in_tenant(email: str, tenant_url: str) -> bool:
     """
     Check if another active deployment exists for the same user in the same tenant.
-    Returns True if another active record is found.
+    Returns True if another active record is found. Results are reused for the rest of the invocation.
     """
+    cache_key = (email, tenant_url)
+    if cache_key in existing_user_cache:
+        return existing_user_cache[cache_key]
+
     try:
-        response = dynamodb.scan(
-            TableName=DEPLOYMENT_STATE_TABLE,
-            FilterExpression="email = :email AND tenant_url = :tenant",
-            ExpressionAttributeValues={
-                ":email": {"S": email},
-                ":tenant": {"S": tenant_url}
-            }
-        )
-        return bool(response.get("Items")) 
+        if DEPLOYMENT_EMAIL_INDEX:
+            # GSI keyed on email (HASH) and tenant_url (RANGE): read only the matching keys
+            response = dynamodb.query(
+                TableName=DEPLOYMENT_STATE_TABLE,
+                IndexName=DEPLOYMENT_EMAIL_INDEX,
+                KeyConditionExpression="email = :email AND tenant_url = :tenant",
+                ExpressionAttributeValues={
+                    ":email": {"S": email},
+                    ":tenant": {"S": tenant_url}
+                },
+                Select="COUNT",
+                Limit=1
+            )
+            exists = response["Count"] > 0
+        else:
+            response = dynamodb.scan(
+                TableName=DEPLOYMENT_STATE_TABLE,
+                FilterExpression="email = :email AND tenant_url = :tenant",
+                ExpressionAttributeValues={
+                    ":email": {"S": email},
+                    ":tenant": {"S": tenant_url}
+                }
+            )
+            exists = bool(response.get("Items"))
     except Exception as e:
         raise RuntimeError(f"Error checking existing deployments: {e}") from e
 
+    existing_user_cache[cache_key] = exists
+    return exists
+
 def process_insert(record: dict):
-    """Handle a new record INSERT event from the DynamoDB stream."""
+    """
+    Handle a new record INSERT event from the DynamoDB stream.
+    Returns the terminal state updates for lambda_handler to commit, or None if the deployment was already processed.
+    """
+    new_image = record["dynamodb"]["NewImage"]
+    logger.debug("Processing new record: %s", new_image)
+
+    dep_id = new_image["dep_id"]["S"]
+    lab_id = new_image["lab_id"]["S"]
+    email = new_image["email"]["S"]
+    petname = new_image["petname"]["S"]
+
+    # Only a freshly dispatched deployment may start, or one an earlier invocation left IN_PROGRESS when it
+    # crashed, timed out or could not commit its terminal state. Batches for a shard never overlap, so a
+    # claim from before this invocation started is abandoned. COMPLETED and FAILED are final and skipped
+    # on stream retries. The claim stays outside the try below: only a claimed deployment may be marked FAILED.
+    claimed = update_deployment_state(
+        dep_id,
+        {"deployment_status": "IN_PROGRESS"},
+        expected="STARTING",
+        abandoned_before=invocation_started_at
+    )
+    if claimed is None:
+        logger.info("Skipping deployment %s: already processed", dep_id)
+        return
+
+    # State changes not yet written to DynamoDB; flushed after each downstream Lambda returns
+    pending = {}
     try:
-        new_image = record["dynamodb"]["NewImage"]
-        print(f"Processing new record: {new_image}")
-
-        dep_id = new_image["dep_id"]["S"]
-        lab_id = new_image["lab_id"]["S"]
-        email = new_image["email"]["S"]
-        petname = new_image["petname"]["S"]
-
-        update_deployment_state(dep_id, {"deployment_status": "IN_PROGRESS"})
-
-        if not NS_CREATE_LAMBDA or not USER_CREATE_LAMBDA or not LAB_CONFIGURATION_TABLE:
-            raise RuntimeError("Missing required environment variables.")
-
         # Fetch lab settings
         lab_info = get_lab_info(lab_id)
 
         ssm_base_path = lab_info["ssm_base_path"]
         group_names = lab_info["group_names"]
-        namespace_roles = lab_info["namespace_roles"]
+        # Copied because the deployment's own namespace role is appended below
+        namespace_roles = list(lab_info["namespace_roles"])
         user_ns = lab_info["user_ns"]
         pre_lambda = lab_info.get("pre_lambda")
 
         # ✅ Step 1: Fetch tenant URL from SSM, update deployment state
         try:
-            region = boto3.session.Session().region_name
-            params = get_parameters([f"{ssm_base_path}/tenant-url"], region_name=region)
+            params = get_parameters([f"{ssm_base_path}/tenant-url"])
             tenant_url = params.get("tenant-url")
         except Exception as e:
             raise RuntimeError(f"Failed to fetch tenant URL: {e}") from e
- 
+
+        # USER_CREATE reuses the tenant credentials when this role may read them; otherwise it fetches its own
+        params = {**params, **get_tenant_credentials(ssm_base_path)}
+
+        # Written straight away so check_existing_user_in_tenant sees this deployment while it is in flight;
+        # an answer cached before the write no longer holds
         update_deployment_state(dep_id, {"tenant_url": tenant_url})
+        existing_user_cache.pop((email, tenant_url), None)
 
         # ✅ Step 2: Create Namespace (if applicable)
         if user_ns:
@@ -152,15 +362,16 @@ def process_insert(record: dict):
                 "description": f"Namespace for {dep_id}"
             }
 
-            update_deployment_state(dep_id, {"create_namespace": "IN_PROGRESS"})
             namespace_response = invoke_lambda(NS_CREATE_LAMBDA, namespace_payload)
             if namespace_response.get("statusCode") == 200:
-                update_deployment_state(dep_id, {"create_namespace": "SUCCESS"})
+                pending["create_namespace"] = "SUCCESS"
                 namespace_roles.append({"namespace": petname, "role": "ves-io-admin-role"})
             else:
-                update_deployment_state(dep_id, {"create_namespace": "FAILED"})
+                pending["create_namespace"] = "FAILED"
+            update_deployment_state(dep_id, pending)
+            pending.clear()
         else:
-            update_deployment_state(dep_id, {"create_namespace": "NA"})
+            pending["create_namespace"] = "NA"
 
         # ✅ Step 3: Create User
         user_payload = {
@@ -171,36 +382,34 @@ def process_insert(record: dict):
             "group_names": group_names,
             "namespace_roles": namespace_roles
         }
+        if USER_CREATE_PARAMETERS <= params.keys():
+            user_payload["resolved_params"] = params
 
-        update_deployment_state(dep_id, {"create_user": "IN_PROGRESS"})
         user_response = invoke_lambda(USER_CREATE_LAMBDA, user_payload)
-        if user_response.get("statusCode") == 200:
-            update_deployment_state(dep_id, {"create_user": "SUCCESS"})
-        else:
-            update_deployment_state(dep_id, {"create_user": "FAILED"})
+        pending["create_user"] = "SUCCESS" if user_response.get("statusCode") == 200 else "FAILED"
+        update_deployment_state(dep_id, pending)
+        pending.clear()
 
         # ✅ Step 4: Execute Pre-Lambda (if defined)
+        # Synchronous so the helper's outcome is recorded; the helpers cannot write their own state
         if pre_lambda:
-            update_deployment_state(dep_id, {"pre_lambda": "IN_PROGRESS"})
             pre_lambda_payload = {
                 "ssm_base_path": ssm_base_path,
                 "petname": petname,
                 "email": email
             }
             pre_lambda_response = invoke_lambda(pre_lambda, pre_lambda_payload)
-
-            if pre_lambda_response.get("statusCode") == 200:
-                update_deployment_state(dep_id, {"pre_lambda": "SUCCESS"})
-            else:
-                update_deployment_state(dep_id, {"pre_lambda": "FAILED"})
+            pending["pre_lambda"] = "SUCCESS" if pre_lambda_response.get("statusCode") == 200 else "FAILED"
         else:
-            update_deployment_state(dep_id, {"pre_lambda": "NA"})
+            pending["pre_lambda"] = "NA"
 
-        update_deployment_state(dep_id, {"deployment_status": "COMPLETED"})
+        # The last step and the terminal status are committed with the rest of the batch
+        pending["deployment_status"] = "COMPLETED"
+        return pending
 
     except Exception as e:
-        update_deployment_state(dep_id, {"deployment_status": "FAILED"})
-        print(f"Error processing INSERT record: {e}")
+        update_deployment_state(dep_id, {**pending, "deployment_status": "FAILED"})
+        logger.error("Error processing INSERT record: %s", e)
         raise
 
 def process_remove(record: dict):
@@ -223,7 +432,7 @@ def process_remove(record: dict):
 
         # ✅ Check if another deployment exists for this user in the same tenant
         if check_existing_user_in_tenant(email, tenant_url):
-            print(f"Skipping user removal: Another active deployment exists for {email} in {tenant_url}")
+            logger.info("Skipping user removal: Another active deployment exists for %s in %s", email, tenant_url)
         else:
             # Step 1: Remove User if it was successfully created
             if create_user == "SUCCESS":
@@ -237,7 +446,7 @@ def process_remove(record: dict):
 
                 user_remove_response = invoke_lambda(USER_REMOVE_LAMBDA, user_payload)
                 if user_remove_response.get("statusCode") != 200:
-                    print(f"Warning: User removal failed for {email}")
+                    logger.warning("User removal failed for %s", email)
 
         # Step 2: Remove Namespace if it was successfully created
         if create_namespace == "SUCCESS":
@@ -251,7 +460,7 @@ def process_remove(record: dict):
 
             ns_remove_response = invoke_lambda(NS_REMOVE_LAMBDA, namespace_payload)
             if ns_remove_response.get("statusCode") != 200:
-                print(f"Warning: Namespace removal failed for {petname}")
+                logger.warning("Namespace removal failed for %s", petname)
 
         # Step 3: Execute Post-Lambda (if defined)
         if post_lambda:
@@ -263,16 +472,53 @@ def process_remove(record: dict):
 
             post_lambda_response = invoke_lambda(post_lambda, post_lambda_payload)
             if post_lambda_response.get("statusCode") != 200:
-                print(f"Warning: Post-Lambda execution failed for {dep_id}")
+                logger.warning("Post-Lambda execution failed for %s", dep_id)
 
     except Exception as e:
-        print(f"Error processing REMOVE record: {e}")
+        logger.error("Error processing REMOVE record: %s", e)
         raise
 
+RECORD_HANDLERS = {
+    "INSERT": process_insert,
+    "REMOVE": process_remove,
+}
+
+def process_records(records: list, terminal_updates: dict):
+    """
+    Process the stream records of a single user in order.
+    Terminal state updates still to be committed are collected in terminal_updates, keyed by dep_id;
+    a later REMOVE discards them since the item is gone.
+    """
+    for record in records:
+        handler = RECORD_HANDLERS.get(record["eventName"])
+        if handler:
+            dep_id = record["dynamodb"]["Keys"]["dep_id"]["S"]
+            updates = handler(record)
+            if updates:
+                terminal_updates[dep_id] = updates
+            else:
+                terminal_updates.pop(dep_id, None)
+
 def lambda_handler(event, context):
     """AWS Lambda entry point for handling DynamoDB stream events."""
+    global invocation_started_at
+    invocation_started_at = int(time.time())
+    existing_user_cache.clear()
+
+    # Group records by user so deployments of the same user keep their stream order:
+    # an INSERT writes tenant_url before a later REMOVE checks whether the user is still in use
+    users = {}
     for record in event["Records"]:
-        if record["eventName"] == "INSERT":
-            process_insert(record)
-        elif record["eventName"] == "REMOVE":
-            process_remove(record)
\ No newline at end of file
+        image = record["dynamodb"].get("NewImage") or record["dynamodb"].get("OldImage", {})
+        user_key = image.get("email", {}).get("S") or record["dynamodb"]["Keys"]["dep_id"]["S"]
+        users.setdefault(user_key, []).append(record)
+
+    terminal_updates = {}
+    futures = [executor.submit(process_records, records, terminal_updates) for records in users.values()]
+    # Let every user finish before surfacing the first failure, so no work is frozen mid-flight
+    wait(futures)
+
+    failures = [future.exception() for future in futures if future.exception()]
+    commit_deployment_states(terminal_updates)
+    if failures:
+        raise failures[0]
@@ -1,43 +1,86 @@
 """
 Create or update a user in an F5 XC tenant.
 """
+import logging
+import os
+import time
 import boto3
+from botocore.config import Config
 from f5xc_tops_py_client import session, user
 
+logger = logging.getLogger()
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO"))
 
-def get_parameters(parameters: list, region_name: str = "us-east-1") -> dict:
+# Built once per container and reused across warm invocations
+boto_config = Config(tcp_keepalive=True, retries={"mode": "adaptive", "max_attempts": 5})
+aws = boto3.session.Session()
+ssm = aws.client("ssm", config=boto_config)
+
+REQUIRED_FIELDS = frozenset({"ssm_base_path", "first_name", "last_name", "email"})
+PARAMETER_CACHE_TTL = 300
+REQUIRED_PARAMETERS = {"tenant-url", "token-value", "idm-type"}
+
+# SSM values keyed by parameter names, as (fetched_at, values)
+parameter_cache = {}
+
+# F5 XC user API clients keyed by tenant_url, as (api_token, client); replaced when the token changes
+user_api_cache = {}
+
+
+def get_parameters(parameters: list) -> dict:
     """
     Fetch parameters from AWS Parameter Store.
+    Values fetched within the last PARAMETER_CACHE_TTL seconds are served from the container cache.
     """
+    cache_key = tuple(parameters)
+    cached = parameter_cache.get(cache_key)
+    if cached and time.monotonic() - cached[0] < PARAMETER_CACHE_TTL:
+        return cached[1]
+
     try:
-        aws = boto3.session.Session()
-        ssm = aws.client("ssm", region_name=region_name)
         response = ssm.get_parameters(Names=parameters, WithDecryption=True)
-        return {param["Name"].split("/")[-1]: param["Value"] for param in response["Parameters"]}
+        params = {param["Name"].rsplit("/", 1)[-1]: param["Value"] for param in response["Parameters"]}
     except Exception as e:
         raise RuntimeError(f"Failed to fetch parameters: {e}") from e
 
+    parameter_cache[cache_key] = (time.monotonic(), params)
+    return params
+
+
+def get_user_api(tenant_url: str, api_token: str):
+    """
+    Return a user API client for the tenant.
+    The authenticated session and its connection pool are reused across warm invocations
+    until the tenant's token changes.
+    """
+    cached = user_api_cache.get(tenant_url)
+    if cached and cached[0] == api_token:
+        return cached[1]
+
+    _api = user(session(tenant_url=tenant_url, api_token=api_token))
+    user_api_cache[tenant_url] = (api_token, _api)
+    return _api
+
 
 def validate_payload(payload: dict):
     """
     Validate the payload for required fields.
     """
-    required_fields = ["ssm_base_path", "first_name", "last_name", "email"]
-    missing_fields = [field for field in required_fields if field not in payload]
+    missing_fields = REQUIRED_FIELDS - payload.keys()
 
     if missing_fields:
-        raise RuntimeError(f"Missing required fields in payload: {', '.join(missing_fields)}")
+        raise RuntimeError(f"Missing required fields in payload: {', '.join(sorted(missing_fields))}")
 
 
 def merge_namespace_roles(existing_roles: list, new_roles: list) -> list:
     """
     Merge existing and new namespace roles, ensuring no duplicates.
+    Existing roles keep their order and new roles are appended after them.
     """
-    existing_roles_set = {frozenset(role.items()) for role in existing_roles}
-    new_roles_set = {frozenset(role.items()) for role in new_roles}
-
-    merged_roles = existing_roles_set | new_roles_set  # Union of both sets
-    return [dict(role) for role in merged_roles]  # Convert back to list of dicts
+    merged_roles = {}
+    for role in existing_roles + new_roles:
+        merged_roles.setdefault((role["namespace"], role["role"]), role)
+    return list(merged_roles.values())
 
 
 def create_user_in_tenant(_api, first_name: str, last_name: str, idm_type: str, email: str, group_names: list, namespace_roles: list) -> str:
@@ -91,18 +134,16 @@ def main(payload: dict):
         group_names = payload.get("group_names", [])
         namespace_roles = payload.get("namespace_roles", [])
 
-        region = boto3.session.Session().region_name
-        params = get_parameters(
-            [
+        # The caller may pass the parameters it already fetched from the same base path
+        params = payload.get("resolved_params")
+        if not params or not REQUIRED_PARAMETERS <= params.keys():
+            params = get_parameters([
                 f"{ssm_base_path}/tenant-url",
                 f"{ssm_base_path}/token-value",
-                f"{ssm_base_path}/idm-type",
-            ],
-            region_name=region,
-        )
+                f"{ssm_base_path}/idm-type"
+            ])
 
-        auth = session(tenant_url=params["tenant-url"], api_token=params["token-value"])
-        _api = user(auth)
+        _api = get_user_api(params["tenant-url"], params["token-value"])
 
         # Attempt to create the user first
         try:
@@ -121,14 +162,14 @@ def main(payload: dict):
                 existing_roles = existing_user.get("namespace_roles", [])
                 existing_group_names = existing_user.get("group_names", [])
 
-                # Merge namespace roles
-                merged_roles = merge_namespace_roles(existing_roles, namespace_roles)
-
-                # Merge group names (remove duplicates)
-                merged_group_names = list(set(existing_group_names) | set(group_names))
+                # Only update if the payload grants a role or group the user does not already have
+                existing_role_keys = {(role["namespace"], role["role"]) for role in existing_roles}
+                new_roles = [role for role in namespace_roles if (role["namespace"], role["role"]) not in existing_role_keys]
+                new_group_names = [g for g in group_names if g not in existing_group_names]
 
-                # Only update if changes are detected
-                if existing_roles != merged_roles or existing_group_names != merged_group_names:
+                if new_roles or new_group_names:
+                    merged_roles = merge_namespace_roles(existing_roles, new_roles)
+                    merged_group_names = list(dict.fromkeys(existing_group_names + new_group_names))
                     result_message = update_user_in_tenant(_api, first_name, last_name, email, merged_roles, merged_group_names)
                 else:
                     result_message = f"User '{email}' already exists with the correct settings. No update needed."
@@ -145,10 +186,10 @@ def main(payload: dict):
             "statusCode": 500,
             "body": f"Error: {e}"
         }
-        print(err)
+        logger.error("%s", err)
         raise RuntimeError(err) from e
 
-    print(res)
+    logger.info("%s", res)
     return res
 
 def lambda_handler(event, context):
@@ -168,4 +209,5 @@ if __name__ == "__main__":
         "group_names": [],
         "namespace_roles": [{"namespace": "default", "role": "ves-io-monitor-role"}]
     }
+    logging.basicConfig()
     main(test_payload)
@@ -1,32 +1,113 @@
 """
 Remove a user from an F5 XC tenant.
 """
-import boto3
+import logging
+import os
+import re
+import time
+import botocore.session
+from botocore.config import Config
 from f5xc_tops_py_client import session, user
 
-
-def get_parameters(parameters: list, region_name: str = "us-east-1") -> dict:
+logger = logging.getLogger()
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO"))
+
+# Built once per container and reused across warm invocations.
+# One SSM call per invocation: a single kept-alive connection and tight timeouts fail fast instead of stalling.
+boto_config = Config(
+    tcp_keepalive=True,
+    max_pool_connections=1,
+    connect_timeout=1.0,
+    read_timeout=3.0,
+    retries={"mode": "standard", "max_attempts": 2}
+)
+# Plain botocore: only one SSM operation is used, so boto3's resource layer is never needed
+aws = botocore.session.get_session()
+region = aws.get_config_variable("region") or os.getenv("AWS_REGION")
+# SSM_ENDPOINT_URL points the client at an SSM VPC interface endpoint; unset keeps botocore's regional endpoint
+ssm = aws.create_client(
+    "ssm",
+    region_name=region,
+    endpoint_url=os.getenv("SSM_ENDPOINT_URL"),
+    config=boto_config
+)
+
+# Operators may inject the tenant credentials directly and skip SSM
+F5XC_TENANT_URL = os.getenv("F5XC_TENANT_URL")
+F5XC_TOKEN = os.getenv("F5XC_TOKEN")
+
+REQUIRED_FIELDS = frozenset({"ssm_base_path", "email"})
+EMAIL_PATTERN = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+PARAMETER_CACHE_TTL = int(os.getenv("SSM_TTL", "300"))
+
+# SSM values keyed by base path, as (fetched_at, values)
+parameter_cache = {}
+
+# F5 XC user API clients keyed by tenant_url, as (api_token, client); replaced when the token changes
+user_api_cache = {}
+
+
+def get_parameters_by_path(base_path: str, ssm_client=ssm) -> dict:
     """
-    Fetch parameters from AWS Parameter Store.
+    Fetch every parameter directly under a base path from AWS Parameter Store,
+    using the module's SSM client unless another is given.
+    Values fetched within the last PARAMETER_CACHE_TTL seconds are served from the container cache.
     """
+    cached = parameter_cache.get(base_path)
+    if cached and time.monotonic() - cached[0] < PARAMETER_CACHE_TTL:
+        return cached[1]
+
     try:
-        aws = boto3.session.Session()
-        ssm = aws.client("ssm", region_name=region_name)
-        response = ssm.get_parameters(Names=parameters, WithDecryption=True)
-        return {param["Name"].split("/")[-1]: param["Value"] for param in response["Parameters"]}
+        paginator = ssm_client.get_paginator("get_parameters_by_path")
+        params = {
+            param["Name"].rsplit("/", 1)[-1]: param["Value"]
+            for page in paginator.paginate(Path=base_path, WithDecryption=True, Recursive=False)
+            for param in page["Parameters"]
+        }
     except Exception as e:
-        raise RuntimeError(f"Failed to fetch parameters: {e}") from e
+        raise RuntimeError("Failed to fetch parameters") from e
+
+    parameter_cache[base_path] = (time.monotonic(), params)
+    return params
+
+
+def get_user_api(tenant_url: str, api_token: str):
+    """
+    Return a user API client for the tenant.
+    The authenticated session and its connection pool are reused across warm invocations
+    until the tenant's token changes.
+    """
+    cached = user_api_cache.get(tenant_url)
+    if cached and cached[0] == api_token:
+        return cached[1]
+
+    _api = user(session(tenant_url=tenant_url, api_token=api_token))
+    user_api_cache[tenant_url] = (api_token, _api)
+    return _api
+
+
+# Opt-in with F5XC_PREWARM=1 and injected credentials: build the client during INIT so the session's
+# whoami call opens the tenant TLS connection before the first invocation. That call has no timeout,
+# so an unreachable tenant holds INIT until Lambda ends it. A failure here is retried on first use.
+if F5XC_TENANT_URL and F5XC_TOKEN and os.getenv("F5XC_PREWARM", "0") == "1":
+    try:
+        get_user_api(F5XC_TENANT_URL, F5XC_TOKEN)
+    except Exception:
+        logger.warning("F5 XC prewarm failed", exc_info=True)
 
 
 def validate_payload(payload: dict):
     """
-    Validate the payload for required fields.
+    Validate the payload for required fields and a well-formed email address.
     """
-    required_fields = ["ssm_base_path", "email"]
-    missing_fields = [field for field in required_fields if field not in payload]
+    missing_fields = REQUIRED_FIELDS - payload.keys()
 
     if missing_fields:
-        raise RuntimeError(f"Missing required fields in payload: {', '.join(missing_fields)}")
+        raise RuntimeError(f"Missing required fields in payload: {', '.join(sorted(missing_fields))}")
+
+    # Reject malformed addresses here rather than after a round trip to the tenant
+    if not isinstance(payload["email"], str) or not EMAIL_PATTERN.match(payload["email"]):
+        raise RuntimeError(f"Invalid email in payload: '{payload['email']}'")
 
 
 def remove_user_from_tenant(_api, email: str) -> str:
@@ -38,30 +119,25 @@ def remove_user_from_tenant(_api, email: str) -> str:
         _api.delete(payload)
         return f"User with email '{email}' removed successfully."
     except Exception as e:
-        raise RuntimeError(f"Failed to remove user: {e}") from e
+        raise RuntimeError("Failed to remove user") from e
 
 
-def main(payload: dict):
+def lambda_handler(event, context):
     """
-    Main function to process the payload and remove the user.
+    AWS Lambda entry point: process the payload and remove the user.
     """
     try:
-        validate_payload(payload)
+        validate_payload(event)
 
-        ssm_base_path = payload["ssm_base_path"]
-        email = payload["email"]
+        ssm_base_path = event["ssm_base_path"]
+        email = event["email"]
 
-        region = boto3.session.Session().region_name
-        params = get_parameters(
-            [
-                f"{ssm_base_path}/tenant-url",
-                f"{ssm_base_path}/token-value"
-            ],
-            region_name=region,
-        )
+        if F5XC_TENANT_URL and F5XC_TOKEN:
+            params = {"tenant-url": F5XC_TENANT_URL, "token-value": F5XC_TOKEN}
+        else:
+            params = get_parameters_by_path(ssm_base_path)
 
-        auth = session(tenant_url=params["tenant-url"], api_token=params["token-value"])
-        _api = user(auth)
+        _api = get_user_api(params["tenant-url"], params["token-value"])
 
         job = remove_user_from_tenant(_api=_api, email=email)
 
@@ -70,23 +146,12 @@ def main(payload: dict):
             "body": job
         }
 
-    except Exception as e:
-        err = {
-            "statusCode": 500,
-            "body": f"Error: {e}"
-        }
-        print(err)
-        raise RuntimeError(err) from e
-
-    print(res)
-    return res
-
-
-def lambda_handler(event, context):
-    """
-    AWS Lambda entry point.
-    """
-    return main(event)
+        logger.info("result=%s", res["statusCode"])
+        logger.debug("%s", res)
+        return res
+    except Exception:
+        logger.exception("User removal failed")
+        raise
 
 
 if __name__ == "__main__":
@@ -95,4 +160,5 @@ if __name__ == "__main__":
         "ssm_base_path": "/tenantOps/app-lab",
         "email": "tops@f5demos.com"
     }
-    main(test_payload)
\ No newline at end of file
+    logging.basicConfig()
+    lambda_handler(test_payload, None)
\ No newline at end of file